@@ -1,48 +1,81 @@
 #! /usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import array
 import curses
+import functools
 import os
+import queue
 import signal
+import threading
 import time
 
+import numpy as np
 import rclpy
 from rclpy.action import ActionClient
+from rclpy.executors import MultiThreadedExecutor
 from rclpy.node import Node
 from control_msgs.action import FollowJointTrajectory
 from trajectory_msgs.msg import JointTrajectoryPoint
 from builtin_interfaces.msg import Duration
-from rclpy.duration import Duration as rclpyDuration
+
+_HELP = ('Use keys 1-9 to select joint, A/D/W/S to adjust, W and S is for small turning 0.001, '
+         'A and D is for 0.01, O and P is for fast turning 1.57, R to reselect, Q to exit.')
 
 
 class TextWindow():
 
+    __slots__ = ('_screen', '_input', '_num_lines', '_last_lines', '_dirty', '_lock')
+
     def __init__(self, stdscr, lines=10):
         self._screen = stdscr
-        self._screen.nodelay(True)
+        # keys are read from a window that is never drawn to, so getch on the
+        # reader thread has nothing to implicitly refresh
+        self._input = curses.newwin(1, 1, 0, 0)
+        self._input.keypad(True)
+        self._input.nodelay(True)
+        self._input.untouchwin()
         curses.curs_set(0)
         self._num_lines = lines
+        self._last_lines = [None] * lines
+        self._dirty = False
+        self._lock = threading.Lock()
 
     def read_key(self):
-        keycode = self._screen.getch()
+        # non-blocking and under the lock: on SIGWINCH wgetch runs resizeterm, which
+        # reallocates stdscr and must not overlap a write from the main thread
+        with self._lock:
+            keycode = self._input.getch()
         return keycode if keycode != -1 else None
 
     def clear(self):
-        self._screen.clear()
+        with self._lock:
+            self._screen.clear()
+            self._last_lines = [None] * self._num_lines
+            self._dirty = True
 
     def write_line(self, lineno, message):
         if lineno < 0 or lineno >= self._num_lines:
             raise ValueError('lineno out of bounds')
-        height, width = self._screen.getmaxyx()
-        y = (height / self._num_lines) * lineno
-        x = 10
-        for text in message.split('\n'):
-            text = text.ljust(width)
-            self._screen.addstr(int(y), int(x), text)
-            y += 1
+        with self._lock:
+            height, width = self._screen.getmaxyx()
+            y = (height / self._num_lines) * lineno
+            x = 10
+            texts = [text.ljust(width) for text in message.split('\n')]
+            if texts == self._last_lines[lineno]:
+                return
+            self._last_lines[lineno] = texts
+            self._dirty = True
+            for text in texts:
+                self._screen.addstr(int(y), int(x), text)
+                y += 1
 
     def refresh(self):
-        self._screen.refresh()
+        with self._lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            self._screen.refresh()
 
     def beep(self):
         curses.flash()
@@ -50,23 +83,72 @@ class TextWindow():
 
 class ArmTeleop(Node):
 
+    # Node itself has no __slots__, so its own attributes still live in __dict__
+    __slots__ = (
+        '_interface', '_pub_cmd_arm', '_pub_cmd_torso', '_pub_cmd_gripper',
+        '_hz', '_dt', '_next', '_running',
+        '_joint_positions_arm', '_joint_position_torso', '_joint_position_gripper',
+        '_selected_joint', '_last_status',
+        '_last_press_key', '_last_press_ns', '_pressed_duration', '_pressed_duration_ns',
+        '_goal_arm', '_point_arm', '_goal_torso', '_point_torso', '_goal_gripper', '_point_gripper',
+        '_server_ready', '_inflight', '_inflight_ns', '_response_timeout_ns', '_pending', '_goal_senders', '_goal_lock',
+        '_send_goal_fns', '_update_fns', '_position_fns',
+        '_key_table', '_key_queue'
+    )
+
     def __init__(self, interface):
         super().__init__('arm_teleop')
 
         self._interface = interface
+        self._draw_help()
         self._pub_cmd_arm = ActionClient(self, FollowJointTrajectory, '/arm_controller/follow_joint_trajectory')
         self._pub_cmd_torso = ActionClient(self, FollowJointTrajectory, '/torso_controller/follow_joint_trajectory')
         self._pub_cmd_gripper = ActionClient(self, FollowJointTrajectory, '/gripper_controller/follow_joint_trajectory')
 
         self._hz = 10
-        self._joint_positions_arm = [0.2, -1.34, -0.2, 1.94, -1.57, 1.37, 0.0]
+        self._dt = 1.0 / self._hz
+        self._next = time.perf_counter()
+        self._joint_positions_arm = np.array([0.2, -1.34, -0.2, 1.94, -1.57, 1.37, 0.0], dtype=np.float64)
         self._joint_position_torso = 0.15
         self._joint_position_gripper = 0.0
         self._selected_joint = None
+        self._last_status = None
         self._running = True
-        self._goal_sent = False
-        self._last_pressed = {}
+        self._last_press_key = None
+        self._last_press_ns = 0
         self._pressed_duration = 0.4
+        self._pressed_duration_ns = int(self._pressed_duration * 1e9)
+        self._goal_arm, self._point_arm = self._make_goal([
+            'arm_1_joint', 'arm_2_joint', 'arm_3_joint',
+            'arm_4_joint', 'arm_5_joint', 'arm_6_joint', 'arm_7_joint'
+        ])
+        self._goal_torso, self._point_torso = self._make_goal(['torso_lift_joint'])
+        self._goal_gripper, self._point_gripper = self._make_goal(
+            ['gripper_right_finger_joint', 'gripper_left_finger_joint'])
+        self._server_ready = {'arm': False, 'torso': False, 'gripper': False}
+        self._inflight = {'arm': None, 'torso': None, 'gripper': None}
+        self._inflight_ns = {'arm': 0, 'torso': 0, 'gripper': 0}
+        self._response_timeout_ns = 2000000000
+        self._pending = {'arm': False, 'torso': False, 'gripper': False}
+        # guards _inflight, _pending and the joint positions, which the executor callbacks share with run();
+        # reentrant because the response callback resends while holding it
+        self._goal_lock = threading.RLock()
+        self._goal_senders = {
+            'arm': self._send_goal_arm,
+            'torso': self._send_goal_torso,
+            'gripper': self._send_goal_gripper
+        }
+        threading.Thread(target=self._wait_for_servers, daemon=True).start()
+
+        # indexed by the selected joint id, see joint_bindings
+        self._send_goal_fns = [self._send_goal_arm] * 7 + [self._send_goal_torso, self._send_goal_gripper]
+        self._update_fns = [functools.partial(self._arm_add, i) for i in range(7)] + [self._torso_add, self._gripper_add]
+        self._position_fns = [lambda i=i: self._joint_positions_arm[i] for i in range(7)] + [
+            lambda: self._joint_position_torso, lambda: self._joint_position_gripper]
+
+        self._key_table = self._build_key_table()
+        self._key_queue = queue.SimpleQueue()
+        threading.Thread(target=self._reader_loop, daemon=True).start()
 
     movement_bindings = {
         ord('a'): -0.01,
@@ -77,6 +159,9 @@ class ArmTeleop(Node):
         ord('p'): 1.57  # fast turning negative
     }
 
+    TORSO = 7
+    GRIPPER = 8
+
     joint_bindings = {
         ord('1'): 0,
         ord('2'): 1,
@@ -85,138 +170,235 @@ class ArmTeleop(Node):
         ord('5'): 4,
         ord('6'): 5,
         ord('7'): 6,
-        ord('8'): 'torso',
-        ord('9'): 'gripper'
+        ord('8'): TORSO,
+        ord('9'): GRIPPER
     }
 
+    selection_labels = [str(i + 1) for i in range(7)] + ['Torso', 'Gripper']
+    position_labels = [f'Joint {i + 1}' for i in range(7)] + ['Torso', 'Gripper']
+
     def run(self):
+        self._next = time.perf_counter()
         while self._running:
-            keycode = self._interface.read_key()
-            if keycode is not None:
+            while True:
+                try:
+                    keycode = self._key_queue.get_nowait()
+                except queue.Empty:
+                    break
                 self._key_pressed(keycode)
-            self._set_velocity()
-            if self._goal_sent:
-                self._publish()
-                self._goal_sent = False
-            time.sleep(1.0 / self._hz)
+            self._interface.refresh()
+            send_goal = self._set_velocity()
+            if send_goal is not None:
+                send_goal()
+            self._wait_for_next_tick()
+
+    @staticmethod
+    def _make_goal(joint_names):
+        goal_msg = FollowJointTrajectory.Goal()
+        goal_msg.trajectory.joint_names = joint_names
 
-    def _key_pressed(self, keycode):
-        if keycode == ord('q'):
-            self._running = False
-            os.kill(os.getpid(), signal.SIGINT)
-        elif keycode in self.joint_bindings:
-            self._selected_joint = self.joint_bindings[keycode]
-            if isinstance(self._selected_joint, int):
-                self._interface.write_line(1, f'Selected Joint: {self._selected_joint + 1}')
+        point = JointTrajectoryPoint()
+        point.time_from_start = Duration(sec=1, nanosec=0)
+
+        goal_msg.trajectory.points = [point]
+        return goal_msg, point
+
+    def _wait_for_next_tick(self):
+        self._next += self._dt
+        remaining = self._next - time.perf_counter()
+        if remaining < 0:
+            # overran the tick, drop the frame instead of catching up
+            self._next = time.perf_counter()
+            return
+        if remaining > 0.001:
+            time.sleep(remaining - 0.0005)
+        while time.perf_counter() < self._next:
+            pass
+
+    def _wait_for_servers(self):
+        for name, client in (('arm', self._pub_cmd_arm),
+                             ('torso', self._pub_cmd_torso),
+                             ('gripper', self._pub_cmd_gripper)):
+            client.wait_for_server()
+            self._server_ready[name] = True
+
+    def _server_available(self, name, client):
+        if not self._server_ready[name]:
+            if not client.wait_for_server(timeout_sec=0.0):
+                self.get_logger().debug(f'{name.capitalize()} action server not available')
+                return False
+            self._server_ready[name] = True
+        return True
+
+    def _goal_in_flight(self, name, client):
+        future = self._inflight[name]
+        if future is None or future.done():
+            return False
+        if not client.server_is_ready() or time.monotonic_ns() - self._inflight_ns[name] > self._response_timeout_ns:
+            # the controller went away or never answered, this response will not arrive
+            self._inflight[name] = None
+            self._pending[name] = False
+            self._server_ready[name] = False
+            return False
+        # only the latest target matters, resend it once this goal is answered
+        self._pending[name] = True
+        return True
+
+    def _reader_loop(self):
+        while self._running:
+            keycode = self._interface.read_key()
+            if keycode is None:
+                time.sleep(0.01)
             else:
-                self._interface.write_line(1, f'Selected Joint: {self._selected_joint.capitalize()}')
-        elif keycode in self.movement_bindings and self._selected_joint is not None:
-            self._last_pressed[keycode] = self.get_clock().now()
-            if isinstance(self._selected_joint, int):
-                self._interface.write_line(2, f'Joint {self._selected_joint + 1} Position: {self._joint_positions_arm[self._selected_joint]:.2f}')
-            elif self._selected_joint == 'torso':
-                self._interface.write_line(2, f'Torso Position: {self._joint_position_torso:.2f}')
-            elif self._selected_joint == 'gripper':
-                self._interface.write_line(2, f'Gripper Position: {self._joint_position_gripper:.2f}')
-        elif keycode == ord('r'):
-            self._selected_joint = None
-            self._interface.write_line(1, 'Reselect Joint')
+                self._key_queue.put(keycode)
+
+    def _build_key_table(self):
+        key_table = [None] * 128
+        for keycode, joint in self.joint_bindings.items():
+            key_table[keycode] = (self._select_joint, joint)
+        for keycode in self.movement_bindings:
+            key_table[keycode] = (self._move, keycode)
+        key_table[ord('q')] = (self._quit, None)
+        key_table[ord('r')] = (self._reselect, None)
+        return key_table
 
-    def _set_velocity(self):
-        now = self.get_clock().now()
-        keys = []
-        for keycode, press_time in self._last_pressed.items():
-            if now - press_time < rclpyDuration(seconds=self._pressed_duration):
-                keys.append(keycode)
-        if keys:
-            for k in keys:
-                if isinstance(self._selected_joint, int):
-                    self._joint_positions_arm[self._selected_joint] += self.movement_bindings[k]
-                elif self._selected_joint == 'torso':
-                    self._joint_position_torso += self.movement_bindings[k]
-                elif self._selected_joint == 'gripper':
-                    self._joint_position_gripper += self.movement_bindings[k]
-                self._goal_sent = True
-            self._last_pressed.clear()
-
-    def _publish(self):
-        self._interface.clear()
-        self._interface.write_line(0, 'Use keys 1-9 to select joint, A/D/W/S to adjust, W and S is for small turning 0.001, A and D is for 0.01, O and P is for fast turning 1.57, R to reselect, Q to exit.')
-        self._interface.refresh()
+    def _key_pressed(self, keycode):
+        if 0 <= keycode < 128:
+            entry = self._key_table[keycode]
+        elif keycode == curses.KEY_RESIZE:
+            entry = (self._redraw, None)
+        else:
+            return
+        if entry is None:
+            return
+        handler, data = entry
+        handler(data)
 
-        if isinstance(self._selected_joint, int):
-            self._send_goal_arm()
-        elif self._selected_joint == 'torso':
-            self._send_goal_torso()
-        elif self._selected_joint == 'gripper':
-            self._send_goal_gripper()
+    def _quit(self, _):
+        self._running = False
+        os.kill(os.getpid(), signal.SIGINT)
 
-    def _send_goal_arm(self):
-        goal_msg = FollowJointTrajectory.Goal()
-        goal_msg.trajectory.joint_names = [
-            'arm_1_joint', 'arm_2_joint', 'arm_3_joint',
-            'arm_4_joint', 'arm_5_joint', 'arm_6_joint', 'arm_7_joint'
-        ]
+    def _select_joint(self, joint):
+        self._selected_joint = joint
+        self._draw_selection()
 
-        point = JointTrajectoryPoint()
-        point.positions = self._joint_positions_arm.copy()
-        point.time_from_start = Duration(sec=1, nanosec=0)
+    def _move(self, keycode):
+        if self._selected_joint is None:
+            return
+        self._last_press_key = keycode
+        self._last_press_ns = time.monotonic_ns()
 
-        goal_msg.trajectory.points = [point]
+    def _reselect(self, _):
+        self._selected_joint = None
+        self._interface.write_line(1, 'Reselect Joint')
 
-        self._pub_cmd_arm.wait_for_server()
-        self._send_goal_future = self._pub_cmd_arm.send_goal_async(goal_msg)
-        self._send_goal_future.add_done_callback(self.goal_response_callback)
+    def _redraw(self, _):
+        self._interface.clear()
+        self._last_status = None
+        self._draw_help()
+        if self._selected_joint is not None:
+            self._draw_selection()
+            self._draw_status()
 
-    def _send_goal_torso(self):
-        goal_msg = FollowJointTrajectory.Goal()
-        goal_msg.trajectory.joint_names = ['torso_lift_joint']
+    def _set_velocity(self):
+        keycode = self._last_press_key
+        if keycode is None:
+            return
+        self._last_press_key = None
+        if self._selected_joint is None:
+            return
+        now_ns = time.monotonic_ns()
+        if now_ns - self._last_press_ns < self._pressed_duration_ns:
+            with self._goal_lock:
+                self._update_fns[self._selected_joint](self.movement_bindings[keycode])
+            self._draw_status()
+            return self._send_goal_fns[self._selected_joint]
+
+    def _draw_help(self):
+        self._interface.write_line(0, _HELP)
+        self._interface.refresh()
 
-        point = JointTrajectoryPoint()
-        point.positions = [self._joint_position_torso]
-        point.time_from_start = Duration(sec=1, nanosec=0)
+    def _draw_selection(self):
+        self._interface.write_line(1, f'Selected Joint: {self.selection_labels[self._selected_joint]}')
 
-        goal_msg.trajectory.points = [point]
+    def _draw_status(self):
+        status = (self._selected_joint, round(self._position_fns[self._selected_joint](), 2))
+        if status != self._last_status:
+            self._last_status = status
+            self._interface.write_line(2, f'{self.position_labels[status[0]]} Position: {status[1]:.2f}')
 
-        self._pub_cmd_torso.wait_for_server()
-        self._send_goal_future = self._pub_cmd_torso.send_goal_async(goal_msg)
-        self._send_goal_future.add_done_callback(self.goal_response_callback)
+    def _arm_add(self, index, delta):
+        self._joint_positions_arm[index] += delta
 
-    def _send_goal_gripper(self):
-        goal_msg = FollowJointTrajectory.Goal()
-        goal_msg.trajectory.joint_names = ['gripper_right_finger_joint', 'gripper_left_finger_joint']
+    def _torso_add(self, delta):
+        self._joint_position_torso += delta
 
-        point = JointTrajectoryPoint()
-        point.positions = [self._joint_position_gripper, self._joint_position_gripper]
-        point.time_from_start = Duration(sec=1, nanosec=0)
+    def _gripper_add(self, delta):
+        self._joint_position_gripper += delta
 
-        goal_msg.trajectory.points = [point]
+    def _send_goal_arm(self):
+        self._send_goal('arm', self._pub_cmd_arm, self._goal_arm, self._point_arm,
+                        array.array('d', self._joint_positions_arm.tobytes()))
 
-        self._pub_cmd_gripper.wait_for_server()
-        self._send_goal_future = self._pub_cmd_gripper.send_goal_async(goal_msg)
-        self._send_goal_future.add_done_callback(self.goal_response_callback)
+    def _send_goal_torso(self):
+        self._send_goal('torso', self._pub_cmd_torso, self._goal_torso, self._point_torso,
+                        array.array('d', (self._joint_position_torso,)))
 
-    def goal_response_callback(self, future):
+    def _send_goal_gripper(self):
+        self._send_goal('gripper', self._pub_cmd_gripper, self._goal_gripper, self._point_gripper,
+                        array.array('d', (self._joint_position_gripper, self._joint_position_gripper)))
+
+    def _send_goal(self, name, client, goal_msg, point, positions):
+        with self._goal_lock:
+            if self._goal_in_flight(name, client):
+                return
+
+            if not self._server_available(name, client):
+                return
+            point.positions = positions
+            send_goal_future = client.send_goal_async(goal_msg)
+            send_goal_future.add_done_callback(functools.partial(self.goal_response_callback, name))
+            self._inflight[name] = send_goal_future
+            self._inflight_ns[name] = time.monotonic_ns()
+
+    def goal_response_callback(self, name, future):
         goal_handle = future.result()
+        with self._goal_lock:
+            # a newer goal may already have been sent once this future reported done
+            if self._inflight[name] is future:
+                self._inflight[name] = None
+            if self._pending[name]:
+                self._pending[name] = False
+                self._goal_senders[name]()
+
+        # logged at debug level, console output would be drawn over the curses screen
         if not goal_handle.accepted:
-            self.get_logger().info('Goal rejected')
+            self.get_logger().debug('Goal rejected')
             return
 
-        self.get_logger().info('Goal accepted')
-        self._get_result_future = goal_handle.get_result_async()
-        self._get_result_future.add_done_callback(self.get_result_callback)
+        self.get_logger().debug('Goal accepted')
+        goal_handle.get_result_async().add_done_callback(self.get_result_callback)
 
     def get_result_callback(self, future):
         result = future.result().result
-        self.get_logger().info(f'Result: {result.error_code}')
+        self.get_logger().debug(f'Result: {result.error_code}')
 
 
 def execute(stdscr):
     rclpy.init()
     app = ArmTeleop(TextWindow(stdscr))
-    app.run()
-    app.destroy_node()
-    rclpy.shutdown()
+    executor = MultiThreadedExecutor()
+    executor.add_node(app)
+    spin_thread = threading.Thread(target=executor.spin, daemon=True)
+    spin_thread.start()
+    try:
+        app.run()
+    finally:
+        executor.shutdown()
+        spin_thread.join(timeout=1.0)
+        app.destroy_node()
+        # quitting with 'q' raises SIGINT, whose rclpy handler already shut the context down
+        rclpy.try_shutdown()
 
 
 def main():